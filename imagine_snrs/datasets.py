@@ -1,3 +1,6 @@
+import os
+from functools import lru_cache
+
 import numpy as np
 from astropy.io import fits
 
@@ -13,32 +16,49 @@ __all__ = ['SNR_DA530_I_1420MHz', 'SNR_DA530_Q_1420MHz', 'SNR_DA530_U_1420MHz',
            'SNR_DA530_I_10450MHz', 'SNR_DA530_Q_10450MHz', 'SNR_DA530_U_10450MHz',
            'SNR_DA530_FD']
 
+# Header keywords used by the datasets (read in a single pass)
+_HEADER_KEYS = ['OBSFREQ'] + [f'{p}{i}' for i in (1, 2)
+                              for p in ('CTYPE','NAXIS','CRPIX','CRVAL','CDELT')]
+
+@lru_cache(maxsize=8)
+def _load_fits_plane(filename):
+    """
+    Reads the image plane and the relevant header keywords of a DA530 FITS
+    file (cached, as the same files are read by several datasets/runs)
+    """
+    with fits.open(filename, memmap=True) as hdul:
+        h = hdul[0].header
+        meta = {k: h[k] for k in _HEADER_KEYS}
+        data = np.ascontiguousarray(hdul[0].data[0,0].T)
+    # The cached array is shared, thus it should not be modified in place
+    data.flags.writeable = False
+    return data, meta
+
+
 class _SNR_DA530_base(img.observables.ImageDataset):
     def __init__(self, crop_lon=None, crop_lat=None):
 
         filename = '../data/{}_DA530{}.fits'.format(self._OTYPE, self._FREQ)
-        hdu = fits.open(filename)[0]
-        data = hdu.data[0,0].T
-        header = hdu.header
+        # NB the cache is keyed on the absolute path, so that changing the
+        # working directory cannot return a different file
+        data, header = _load_fits_plane(os.path.abspath(filename))
+        data = data.copy()
         frequency = header['OBSFREQ']*u.Hz
 
         val_min = {}
         val_max = {}
-        val_arr = {}
         delta = {}
 
+        # NB header is a plain dict with the keywords in _HEADER_KEYS
         for i in (1, 2):
-            i = str(i)
-
-            q = header['CTYPE' + i]
-            n_pix = header['NAXIS' + i]
-            ref_pos = header['CRPIX' + i]
-            ref_val = header['CRVAL' + i]
-            delta[q] = header['CDELT' + i]
+            q = header[f'CTYPE{i}']
+            n_pix = header[f'NAXIS{i}']
+            ref_pos = header[f'CRPIX{i}']
+            ref_val = header[f'CRVAL{i}']
+            delta[q] = header[f'CDELT{i}']
 
             val_min[q] = ref_val - delta[q]*(ref_pos-1)
             val_max[q] = ref_val + delta[q]*(n_pix - ref_pos)
-            val_arr[q] = np.arange(val_min[q], val_max[q] + delta[q]/2, delta[q]) - ref_val
 
         if self._OTYPE == 'RM':
             otype = 'fd'
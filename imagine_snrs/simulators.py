@@ -1,3 +1,4 @@
+from functools import lru_cache
 import astropy.units as u
 import numpy as np
 
@@ -8,6 +9,30 @@ from scipy.spatial.transform import Rotation as scipy_rotation
 import astropy.units as u
 
 
+@lru_cache(maxsize=8)
+def _sync_constant(gamma):
+    """
+    Synchrotron emissivity constant for a given cosmic ray spectral index
+
+    The result (a Quantity) is cached, as it only depends on `gamma` and
+    is needed for every simulated synchrotron image.
+    """
+    from math import sqrt, pi
+    from astropy.constants import c, e, m_e
+    e = e.esu
+
+    #return ( (sqrt(3) * e**3) / (8*pi*m_e*c**2)
+            #*(4*pi*m_e*c/(3*e))**((1-gamma)/2) ) * c**((1-gamma)/2)
+    A = sqrt(3) * e**3 / (8*pi*m_e*c**2)
+    B = (4*pi*m_e*c**2 / (3*e))**((1-gamma)/2)
+
+    # The following is a hack to deal with a missing equivalency in
+    # astropy units
+    B_unit_adj = (1./u.gauss) * (u.Fr/u.cm**2)  # This should be 1
+
+    return A*B * B_unit_adj**((gamma+1)/2)
+
+
 class SimpleSynchrotron(Simulator):
     """
     Simulates the radio images associated with the synchrotron emission signal
@@ -35,6 +60,9 @@ class SimpleSynchrotron(Simulator):
         The interpolation method used by `scipy.interpolate.RegularGridInterpolator`
         to interpolate the resulting images to the same dimensions as the
         images in the `measurements`.
+    use_gpu : bool
+        If `True`, the line-of-sight integration of the Stokes parameters
+        is performed on a CUDA GPU (if one is available).
     """
     # Class attributes
     SIMULATED_QUANTITIES = ['sync', 'fd']
@@ -44,8 +72,10 @@ class SimpleSynchrotron(Simulator):
     ALLOWED_GRID_TYPES = ['cartesian']
 
     def __init__(self, measurements, distance, gamma=1.0, wavelength_factor=1.01,
-                 beam_kernel_sd=None, backlit_RM=True, interp_method='nearest'):
+                 beam_kernel_sd=None, backlit_RM=True, interp_method='nearest',
+                 use_gpu=False):
         super().__init__(measurements)
+        self.use_gpu = use_gpu
         self.gamma = gamma
         self.Stokes = {}
         self.interp_method = interp_method
@@ -69,18 +99,6 @@ class SimpleSynchrotron(Simulator):
         else:
             raise ValueError
 
-
-    def _sync_constant(self, gamma):
-        from math import sqrt, pi
-        from astropy.constants import c, e, m_e
-        e = e.esu
-
-        #return ( (sqrt(3) * e**3) / (8*pi*m_e*c**2)
-                #*(4*pi*m_e*c/(3*e))**((1-gamma)/2) ) * c**((1-gamma)/2)
-        A = sqrt(3) * e**3 / (8*pi*m_e*c**2)
-        B = (4*pi*m_e*c**2 / (3*e))**((1-gamma)/2)
-        return A*B
-
     def simulate(self, key, coords_dict, realization_id, output_units):
 
         obs_name, freq, _, flag = key
@@ -106,7 +124,8 @@ class SimpleSynchrotron(Simulator):
             I, U, Q = obs.compute_stokes_parameters(grid, wavelength,
                                                     Bx, By, Bz,
                                                     ne, ncr, gamma=self.gamma,
-                                                    beam_kernel_sd=self.beam_kernel_sd)
+                                                    beam_kernel_sd=self.beam_kernel_sd,
+                                                    use_gpu=self.use_gpu)
             self.Stokes['I'] = I
             self.Stokes['Q'] = Q
             self.Stokes['U'] = U
@@ -116,7 +135,8 @@ class SimpleSynchrotron(Simulator):
                 _, U2, Q2 = obs.compute_stokes_parameters(grid, wavelength2,
                                                           Bx, By, Bz,
                                                           ne, ncr, gamma=self.gamma,
-                                                          beam_kernel_sd=self.beam_kernel_sd)
+                                                          beam_kernel_sd=self.beam_kernel_sd,
+                                                          use_gpu=self.use_gpu)
                 Psi1 = obs.compute_Psi(U, Q)
                 Psi2 = obs.compute_Psi(U2, Q2)
                 RM = obs.compute_RM(Psi1, Psi2, wavelength, wavelength2)
@@ -158,14 +178,7 @@ class SimpleSynchrotron(Simulator):
 
         # Adjusts the units
         if obs_name == 'sync':
-            sync_constant = self._sync_constant(self.gamma)
-
-            # The following is a hack to deal with a missing equivalency in
-            # astropy units
-            B_unit_adj = (1./u.gauss) * (u.Fr/u.cm**2)  # This should be 1
-            sync_constant *= B_unit_adj**((self.gamma+1)/2)
-
-            result = result * sync_constant
+            result = result * _sync_constant(self.gamma)
 
             # The result, so far, corresponds to a surface density of luminosity,
             # i.e. the energy per area in the remnant, but we want flux density,
@@ -209,6 +222,9 @@ class LoS_integrator(Simulator):
         The interpolation method used by `scipy.interpolate.RegularGridInterpolator`
         to interpolate the resulting images to the same dimensions as the
         images in the `measurements`.
+    use_gpu : bool
+        If `True`, the line-of-sight integration of the Stokes parameters
+        is performed on a CUDA GPU (if one is available).
     """
     # Class attributes
     SIMULATED_QUANTITIES = ['sync', 'fd']
@@ -218,8 +234,9 @@ class LoS_integrator(Simulator):
     ALLOWED_GRID_TYPES = ['cartesian']
 
     def __init__(self, measurements, gamma=1.,
-                 beam_kernel_sd=None, interp_method='nearest'):
+                 beam_kernel_sd=None, interp_method='nearest', use_gpu=False):
         super().__init__(measurements)
+        self.use_gpu = use_gpu
         self.gamma = gamma
         self.Stokes = {}
         self.interp_method = interp_method
@@ -240,15 +257,6 @@ class LoS_integrator(Simulator):
         else:
             raise ValueError
 
-    def _sync_constant(self, gamma):
-        from math import sqrt, pi
-        from astropy.constants import c, e, m_e
-        e = e.esu
-
-        A = sqrt(3) * e**3 / (8*pi*m_e*c**2)
-        B = (4*pi*m_e*c**2 / (3*e))**((1-gamma)/2)
-        return A*B
-
     def _find_ranges(self, coords):
         """
         Finds the coordinate ranges necessary for constructing the simulated image
@@ -416,7 +424,8 @@ class LoS_integrator(Simulator):
                 I, U, Q = obs.compute_stokes_parameters(depth, wavelength,
                                                         Bperp_x, Bperp_y, B_para,
                                                         ne, ncr, gamma=self.gamma,
-                                                        beam_kernel_sd=self.beam_kernel_sd)
+                                                        beam_kernel_sd=self.beam_kernel_sd,
+                                                        use_gpu=self.use_gpu)
                 self.Stokes['I'] = I
                 self.Stokes['Q'] = Q
                 self.Stokes['U'] = U
@@ -461,14 +470,7 @@ class LoS_integrator(Simulator):
 
         # Adjusts the units
         if obs_name == 'sync':
-            sync_constant = self._sync_constant(self.gamma)
-
-            # The following is a hack to deal with a missing equivalency in
-            # astropy units
-            B_unit_adj = (1./u.gauss) * (u.Fr/u.cm**2)  # This should be 1
-            sync_constant *= B_unit_adj**((self.gamma+1)/2)
-
-            result = result * sync_constant
+            result = result * _sync_constant(self.gamma)
 
             # The result, so far, corresponds to a surface density of luminosity,
             # i.e. the energy per area in the remnant, but we want flux density,
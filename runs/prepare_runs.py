@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 import os, sys
 sys.path.append('../')
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
+import numba
 import numpy as np
 import astropy.units as u
 
@@ -27,6 +30,18 @@ likelihood = img.likelihoods.SimpleLikelihood(measurements)
 L = 70*u.pc; N = 200
 grid = img.fields.UniformGrid(box=[[-L,L],[-L,L],[-L,L]],
                               resolution=[N, N, N])
+# Evaluates the (lazily computed) coordinate arrays once, so that they
+# are shared by all the fields and pipelines using this grid
+grid.x, grid.y, grid.z
+
+# ----------------- Priors shared by several factories --------------------------
+
+prior_B = FlatPrior(0, 10, u.microgauss)
+prior_angle = FlatPrior(-180, 180, u.deg, wrapped=True)
+prior_beta = FlatPrior(-90, 90, u.deg)
+prior_shift = FlatPrior(-L,L)
+prior_period = FlatPrior(10,120, u.pc)
+prior_period_z = FlatPrior(10,220, u.pc)
 
 # ----------------- Field factories --------------------------
 
@@ -50,18 +65,18 @@ B_uniform_factory  = FieldFactory(grid=grid,
                                   field_class=img_snrs.fields.SNRUniformMagneticField,
                                   active_parameters =('B', 'beta', 'gamma'),
                                   default_parameters={},
-                                    priors={'B': FlatPrior(0, 10, u.microgauss),
-                                            'beta': FlatPrior(-90, 90, u.deg),
-                                            'gamma': FlatPrior(-180, 180, u.deg, wrapped=True)})
+                                    priors={'B': prior_B,
+                                            'beta': prior_beta,
+                                            'gamma': prior_angle})
 
 B_helical_factory  = FieldFactory(grid=grid,
                                   field_class=img_snrs.fields.SNRSimpleHelicalMagneticField,
                                   active_parameters =('B', 'alpha', 'beta', 'gamma', 'period'),
                                   default_parameters={},
-                                    priors={'B': FlatPrior(0, 10, u.microgauss),
-                                            'alpha': FlatPrior(-180, 180, u.deg, wrapped=True),
-                                            'beta': FlatPrior(-90, 90, u.deg),
-                                            'gamma': FlatPrior(-180, 180, u.deg, wrapped=True),
+                                    priors={'B': prior_B,
+                                            'alpha': prior_angle,
+                                            'beta': prior_beta,
+                                            'gamma': prior_angle,
                                             'period': FlatPrior(10,70, u.pc)})
 
 B_BMF_factory = FieldFactory(grid=grid,
@@ -70,12 +85,12 @@ B_BMF_factory = FieldFactory(grid=grid,
                                                 'x_shift', 'y_shift',
                                                 'alpha', 'beta'],
                              default_parameters={'B': 1*u.microgauss},
-                             priors={'B': FlatPrior(0, 10, u.microgauss),
-                                     'alpha': FlatPrior(-180, 180, u.deg, wrapped=True),
-                                     'beta': FlatPrior(-90, 90, u.deg),
-                                     'x_shift': FlatPrior(-L,L),
-                                     'y_shift': FlatPrior(-L,L),
-                                     'period': FlatPrior(10,120, u.pc)})
+                             priors={'B': prior_B,
+                                     'alpha': prior_angle,
+                                     'beta': prior_beta,
+                                     'x_shift': prior_shift,
+                                     'y_shift': prior_shift,
+                                     'period': prior_period})
 
 B_CK_m0_factory = FieldFactory(grid=grid,
                                field_class=img_snrs.fields.SNR_CK_MagneticField,
@@ -85,14 +100,14 @@ B_CK_m0_factory = FieldFactory(grid=grid,
                                default_parameters={'B': 1*u.microgauss,
                                                    'm': 0,
                                                    'z_shift': 0*u.pc},
-                                   priors={'B': FlatPrior(0, 10, u.microgauss),
-                                           'alpha': FlatPrior(-180, 180, u.deg, wrapped=True),
-                                           'beta': FlatPrior(-90, 90, u.deg),
-                                           'gamma': FlatPrior(-180, 180, u.deg, wrapped=True),
-                                           'x_shift': FlatPrior(-L,L),
-                                           'y_shift': FlatPrior(-L,L),
-                                           'period': FlatPrior(10,120, u.pc),
-                                           'period_z': FlatPrior(10,220, u.pc)})
+                                   priors={'B': prior_B,
+                                           'alpha': prior_angle,
+                                           'beta': prior_beta,
+                                           'gamma': prior_angle,
+                                           'x_shift': prior_shift,
+                                           'y_shift': prior_shift,
+                                           'period': prior_period,
+                                           'period_z': prior_period_z})
 
 B_CK_m1_factory = FieldFactory(grid=grid,
                                field_class=img_snrs.fields.SNR_CK_MagneticField,
@@ -102,14 +117,14 @@ B_CK_m1_factory = FieldFactory(grid=grid,
                                default_parameters={'B': 1*u.microgauss,
                                                    'm': 1,
                                                    'z_shift': 0*u.pc},
-                                   priors={'B': FlatPrior(0, 10, u.microgauss),
-                                           'alpha': FlatPrior(-180, 180, u.deg, wrapped=True),
-                                           'beta': FlatPrior(-90, 90, u.deg),
-                                           'gamma': FlatPrior(-180, 180, u.deg, wrapped=True),
-                                           'x_shift': FlatPrior(-L,L),
-                                           'y_shift': FlatPrior(-L,L),
-                                           'period': FlatPrior(10,120, u.pc),
-                                           'period_z': FlatPrior(10,220, u.pc)})
+                                   priors={'B': prior_B,
+                                           'alpha': prior_angle,
+                                           'beta': prior_beta,
+                                           'gamma': prior_angle,
+                                           'x_shift': prior_shift,
+                                           'y_shift': prior_shift,
+                                           'period': prior_period,
+                                           'period_z': prior_period_z})
 
 CR_factory = FieldFactory(grid=grid,
                           field_class=img_snrs.fields.EquipartitionCosmicRayElectrons,
@@ -152,11 +167,46 @@ pipeline_CK_m1.name = 'CK (m=1) initial magnetic field'
 pipelines = [pipeline_simple_helical, pipeline_uniform, pipeline_BMF,
              pipeline_CK_m0, pipeline_CK_m1]
 
-for p in pipelines:
+# All the pipelines share the same grid (and thus the same coordinate arrays)
+assert all(factory.grid is grid
+           for p in pipelines for factory in p.factory_list)
+
+def _init_worker(n_threads):
+    """
+    Limits the numba threads of each worker, so that the parallel
+    kernels of the workers do not oversubscribe the CPUs
+    """
+    numba.set_num_threads(n_threads)
+
+
+def _run_one(i):
+    """
+    Tests and saves the i-th pipeline
+
+    NB The pipelines are selected by index (instead of being pickled):
+    each worker process re-imports this module and rebuilds them. Thus,
+    every worker (and the parent) holds its own copy of the datasets, grid
+    and pipelines, i.e. the peak memory is roughly (number of pipelines + 1)
+    times that of a serial run.
+    """
+    p = pipelines[i]
     p.likelihood_rescaler = 1e-9
     p.sampling_controllers={'min_num_live_points':200}
     print('\nTesting', p.name, '\n')
     p.test(n_points=2)
     print('\nSaving', p.name)
     p.save()
+    return p.name
+
+
+if __name__ == '__main__':
+    # The pipelines are independent, thus can be prepared in parallel
+    n_workers = len(pipelines)
+    n_threads = max(1, os.cpu_count()//n_workers)
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(n_threads,)) as executor:
+        for name in executor.map(_run_one, range(len(pipelines))):
+            print('\nFinished', name)
 
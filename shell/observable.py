@@ -1,15 +1,13 @@
-from scipy.integrate import trapz, cumtrapz #, simps
+import math
 import numpy as np
-from numba import jit, njit, vectorize
+from numba import jit, njit, vectorize, prange, cuda
 import astropy.units as u
 from scipy.ndimage import gaussian_filter
 import warnings
 
-pi = np.pi*u.rad # convenience
-integrate = trapz
-
 def compute_stokes_parameters(depth_grid, wavelength, Bx, By, Bz,
-                              ne, ncr, gamma=3, beam_kernel_sd=None):
+                              ne, ncr, gamma=3, beam_kernel_sd=None,
+                              use_gpu=False, dtype=np.float32):
     """
     Computes Stokes I, Q, U integrated along z axis
 
@@ -34,6 +32,13 @@ def compute_stokes_parameters(depth_grid, wavelength, Bx, By, Bz,
         If different from `None`, the resulting signal is convolved with
         a gaussian kernel with standard deviation `beam_kernel_sd` (in pixels).
         Otherwise, a pencil beam is assumed.
+    use_gpu : bool
+        If `True`, the line-of-sight integration is performed on a CUDA
+        GPU (if one is available).
+    dtype : numpy.dtype
+        Floating point type in which the gridded fields are passed to the
+        integration kernel. The default (`float32`) halves the memory
+        traffic; the integrals are always accumulated in double precision.
 
     Returns
     -------
@@ -48,53 +53,246 @@ def compute_stokes_parameters(depth_grid, wavelength, Bx, By, Bz,
     if hasattr(depth_grid,'z'):
         warnings.warn("The synthax of this function has changed: one should "
                       "provide a depth grid (array) instead of a full IMAGINE grid", DeprecationWarning)
-        depth_grid = depth_grid.z
-
-    Bperp2 = Bx**2+By**2
-
-    emissivity = ncr * Bperp2**((gamma+1)/4) * wavelength**((gamma-1)/2)
-
-    # Total synchrotron intensity
-    I = integrate(emissivity, depth_grid, axis=2)
-
-    # Intrinsic polarization angles
-    psi0 = np.arctan(By/Bx) + pi/2
-    
-    # Deals with the case where By and Bx are *exact* zero
-    # (generally, this is an artifact of interpolation)
-    ok = (By == 0) * (Bx == 0)
-    psi0[ok] = 0
-    
-    # Keeps angles in the [-pi pi] interval
-    psi0[psi0>pi] = psi0[psi0>pi]-2*pi
-    psi0[psi0<-pi] = psi0[psi0<-pi]+2*pi
-
-    # Cummulative Faraday rotation (i.e. rotation up to a given depth)
-    if wavelength != 0:
-        integrand = Bz.to_value(u.microgauss)*ne.to_value(u.cm**-3)
-        RM = (0.812*u.rad/u.m**2) * cumtrapz(integrand,
-                                             depth_grid.to_value(u.pc),
-                                             axis=2, initial=0)
+        # The depth is the same for every line of sight in a cartesian grid
+        depth_grid = depth_grid.z[0,0,:]
+
+    # Strips the units, so that the arithmetic can be done by the
+    # (numba-accelerated) kernel on plain C-contiguous arrays
+    Bx, By, Bz = [np.ascontiguousarray(B.to_value(u.microgauss), dtype=dtype)
+                  for B in (Bx, By, Bz)]
+    ne = np.ascontiguousarray(ne.to_value(u.cm**-3), dtype=dtype)
+    ncr = np.ascontiguousarray(ncr.to_value(u.cm**-3), dtype=dtype)
+    depth = depth_grid.to_value(u.pc)
+    if depth.ndim == 1:
+        # A single depth array shared by all the lines of sight
+        depth = depth.reshape(1, 1, -1)
+
+    if use_gpu and not cuda.is_available():
+        warnings.warn("No CUDA GPU available: using the CPU instead", RuntimeWarning)
+        use_gpu = False
+
+    # A single output buffer is used for I, Q and U and all the subsequent
+    # operations are done in place
+    stokes = np.empty(Bx.shape[:2] + (3,))
+
+    if use_gpu:
+        # Only the (possibly 1D) depth array is transferred to the device
+        _stokes_kernel_gpu(Bx, By, Bz, ne, ncr, depth,
+                           wavelength.to_value(u.m), gamma, stokes)
     else:
-        # Avoids unnecessary calculation
-        RM = 0.0 * u.rad/u.m**2
+        # NB broadcast_to returns a (stride 0) view, nothing is copied
+        _stokes_kernel(Bx, By, Bz, ne, ncr, np.broadcast_to(depth, Bx.shape),
+                       wavelength.to_value(u.m), gamma, stokes)
+
+    if beam_kernel_sd is not None:
+        # Smooths the three images at once (no smoothing along the last axis)
+        sigma = tuple(np.broadcast_to(beam_kernel_sd, 2)) + (0,)
+        gaussian_filter(stokes, sigma=sigma, output=stokes)
 
-    # Rotated polarization angle grid
-    psi = psi0 + wavelength**2*RM
-    
     # Intrinsic polarization degree
     p0 = (gamma+1)/(gamma+7/3)
+    stokes[...,1:] *= p0
 
-    # Stokes Q and U
-    U = p0*integrate(emissivity * np.sin(2*psi), depth_grid, axis=2)
-    Q = p0*integrate(emissivity * np.cos(2*psi), depth_grid, axis=2)
-
-    if beam_kernel_sd is not None:
-        I, U, Q = [ gaussian_filter(Stokes.value, sigma=beam_kernel_sd)*Stokes.unit
-                    for Stokes in (I, U, Q) ]
+    # Restores the units (only on the final 2D images)
+    unit = u.cm**-3 * u.microgauss**((gamma+1)/2) * u.m**((gamma-1)/2) * u.pc
+    I, Q, U = [stokes[...,n] << unit for n in range(3)]
 
     return I, U, Q
 
+
+def _integrate_line_of_sight(Bx, By, Bz, ne, ncr, z,
+                             exponent, wl_pow, rotation_factor):
+    """
+    Integrates Stokes I, Q and U along a single line of sight
+
+    The cumulative Faraday rotation and the trapezoidal integrals are
+    accumulated in local scalars (always in double precision), avoiding
+    the construction of any temporary array. This is compiled both for
+    the CPU (`_stokes_kernel`) and as a CUDA device function
+    (`_stokes_cuda_kernel`).
+
+    Parameters
+    ----------
+    Bx, By, Bz : numpy.ndarray
+        1D arrays with the magnetic field components in microgauss
+    ne, ncr : numpy.ndarray
+        1D arrays with the thermal and cosmic ray electron densities in cm^-3
+    z : numpy.ndarray
+        1D array with the line-of-sight depth in pc
+    exponent : float
+        Exponent of Bperp^2 in the emissivity, (gamma+1)/4
+    wl_pow : float
+        Wavelength factor of the emissivity, wavelength**((gamma-1)/2)
+    rotation_factor : float
+        Faraday rotation factor, 0.812 * wavelength**2 (wavelength in m)
+
+    Returns
+    -------
+    I, Q, U : float
+        Integrated Stokes parameters (Q and U do not include the intrinsic
+        polarization degree factor)
+    """
+    # Avoids unnecessary calculation (and memory access) if there is
+    # no Faraday rotation
+    faraday_rotation = rotation_factor != 0
+
+    rm = 0.0
+    I_acc = 0.0
+    Q_acc = 0.0
+    U_acc = 0.0
+    em_prev = 0.0
+    Q_prev = 0.0
+    U_prev = 0.0
+    integrand_prev = 0.0
+    cos_rot = 1.0
+    sin_rot = 0.0
+    dz = 0.0
+    for k in range(Bx.shape[0]):
+        if k > 0:
+            dz = z[k] - z[k-1]
+
+        bx = Bx[k]
+        by = By[k]
+        Bperp2 = bx*bx + by*by
+        # Avoids the (expensive) generic power in the common cases
+        # (e.g. gamma=3 or gamma=1)
+        if exponent == 1.0:
+            Bperp_pow = Bperp2
+        elif exponent == 0.5:
+            Bperp_pow = math.sqrt(Bperp2)
+        else:
+            Bperp_pow = Bperp2**exponent
+        em = ncr[k] * Bperp_pow * wl_pow
+
+        # Cummulative Faraday rotation (i.e. rotation up to this depth)
+        if faraday_rotation:
+            integrand = Bz[k] * ne[k]
+            rm += 0.5*(integrand + integrand_prev)*dz
+            integrand_prev = integrand
+            # Rotation of 2*psi (sine and cosine of the same
+            # argument, which can share the range reduction)
+            two_phi = 2*rotation_factor*rm
+            cos_rot = math.cos(two_phi)
+            sin_rot = math.sin(two_phi)
+
+        # Intrinsic polarization angle, psi0 = atan2(By, Bx) + pi/2.
+        # Its double-angle cosine and sine follow directly from the
+        # field components (for Bx=By=0, atan2 would return 0)
+        if Bperp2 > 0:
+            cos_2psi0 = (by*by - bx*bx)/Bperp2
+            sin_2psi0 = -2*bx*by/Bperp2
+        else:
+            cos_2psi0 = -1.0
+            sin_2psi0 = 0.0
+
+        # Rotated polarization angle, psi = psi0 + phi
+        Q_k = em * (cos_2psi0*cos_rot - sin_2psi0*sin_rot)
+        U_k = em * (sin_2psi0*cos_rot + cos_2psi0*sin_rot)
+
+        I_acc += 0.5*(em + em_prev)*dz
+        Q_acc += 0.5*(Q_k + Q_prev)*dz
+        U_acc += 0.5*(U_k + U_prev)*dz
+
+        em_prev = em
+        Q_prev = Q_k
+        U_prev = U_k
+
+    return I_acc, Q_acc, U_acc
+
+_integrate_line_of_sight_cpu = njit(inline='always')(_integrate_line_of_sight)
+_integrate_line_of_sight_gpu = cuda.jit(device=True)(_integrate_line_of_sight)
+
+
+@njit(parallel=True, fastmath=True)
+def _stokes_kernel(Bx, By, Bz, ne, ncr, z, wavelength, gamma, stokes):
+    """
+    Integrates Stokes I, Q and U along the z axis for every pixel
+
+    Parameters
+    ----------
+    Bx, By, Bz : numpy.ndarray
+        (Nx, Ny, Nz) arrays with the magnetic field components in microgauss
+        (single or double precision)
+    ne, ncr : numpy.ndarray
+        (Nx, Ny, Nz) arrays with the thermal and cosmic ray electron
+        densities in cm^-3 (single or double precision)
+    z : numpy.ndarray
+        (Nx, Ny, Nz) array with the line-of-sight depth in pc
+    wavelength : float
+        The wavelength of the observation in m
+    gamma : float
+        Spectral index of the cosmic ray electron distribution
+    stokes : numpy.ndarray
+        (Nx, Ny, 3) output array, which is filled with the integrated
+        Stokes I, Q and U (Q and U do not include the intrinsic
+        polarization degree factor).
+    """
+    Nx, Ny, Nz = Bx.shape
+
+    exponent = (gamma+1)/4
+    wl_pow = wavelength**((gamma-1)/2)
+    # Faraday rotation: 0.812 rad m^-2 per (microgauss cm^-3 pc)
+    rotation_factor = 0.812 * wavelength**2
+
+    for i in prange(Nx):
+        for j in range(Ny):
+            I, Q, U = _integrate_line_of_sight_cpu(
+                Bx[i,j], By[i,j], Bz[i,j], ne[i,j], ncr[i,j], z[i,j],
+                exponent, wl_pow, rotation_factor)
+            stokes[i,j,0] = I
+            stokes[i,j,1] = Q
+            stokes[i,j,2] = U
+
+
+def _stokes_kernel_gpu(Bx, By, Bz, ne, ncr, z, wavelength, gamma, stokes):
+    """
+    GPU version of `_stokes_kernel` (same inputs and outputs, except that
+    the depth may also be a (1, 1, Nz) array shared by all lines of sight)
+
+    The arrays are transferred to the device with the depth as the
+    outermost axis, so that threads handling neighbouring lines of sight
+    access contiguous memory.
+    """
+    Nx, Ny, Nz = Bx.shape
+    arrays = [cuda.to_device(np.ascontiguousarray(np.moveaxis(a, 2, 0)))
+              for a in (Bx, By, Bz, ne, ncr, z)]
+    stokes_device = cuda.device_array(stokes.shape)
+
+    threads_per_block = (16, 16)
+    blocks = ((Ny+15)//16, (Nx+15)//16)
+    _stokes_cuda_kernel[blocks, threads_per_block](*arrays, wavelength, gamma,
+                                                   stokes_device)
+
+    stokes_device.copy_to_host(stokes)
+
+
+@cuda.jit
+def _stokes_cuda_kernel(Bx, By, Bz, ne, ncr, z, wavelength, gamma, stokes):
+    """
+    CUDA kernel integrating Stokes I, Q and U along the line of sight,
+    with one thread per (x, y) pixel. The input arrays have shape
+    (Nz, Nx, Ny) (or (Nz, 1, 1), for the depth) and the output, (Nx, Ny, 3).
+    """
+    iy, ix = cuda.grid(2)
+    Nz, Nx, Ny = Bx.shape
+    if ix >= Nx or iy >= Ny:
+        return
+
+    exponent = (gamma+1)/4
+    wl_pow = wavelength**((gamma-1)/2)
+    rotation_factor = 0.812 * wavelength**2
+
+    ixz = ix if z.shape[1] > 1 else 0
+    iyz = iy if z.shape[2] > 1 else 0
+    I, Q, U = _integrate_line_of_sight_gpu(
+        Bx[:,ix,iy], By[:,ix,iy], Bz[:,ix,iy], ne[:,ix,iy], ncr[:,ix,iy],
+        z[:,ixz,iyz], exponent, wl_pow, rotation_factor)
+
+    stokes[ix,iy,0] = I
+    stokes[ix,iy,1] = Q
+    stokes[ix,iy,2] = U
+
+
 def compute_fd(depth_grid, Bz, ne, beam_kernel_sd=None):
     """
     Computes RM/faraday depth
@@ -124,17 +322,46 @@ def compute_fd(depth_grid, Bz, ne, beam_kernel_sd=None):
         warnings.warn("The synthax of this function has changed: one should "
                       "provide a depth grid (array) instead of a full IMAGINE grid",
                       DeprecationWarning)
-        depth_grid = depth_grid.z
+        # The depth is the same for every line of sight in a cartesian grid
+        depth_grid = depth_grid.z[0,0,:]
+
+    depth = depth_grid.to_value(u.pc)
+    weights = _trapezoidal_weights(depth)
+
+    # Trapezoidal integration of Bz*ne as a single weighted reduction
+    # (avoids the temporary arrays created by trapz)
+    subscripts = 'ijk,ijk,k->ij' if depth.ndim == 1 else 'ijk,ijk,ijk->ij'
+    RM = 0.812 * np.einsum(subscripts,
+                           Bz.to_value(u.microgauss),
+                           ne.to_value(u.cm**-3),
+                           weights)
+    if beam_kernel_sd is not None:
+        RM = gaussian_filter(RM, sigma=beam_kernel_sd)
 
-    integrand = Bz.to_value(u.microgauss)*ne.to_value(u.cm**-3)
+    return RM << u.rad/u.m**2
 
-    RM = (0.812*u.rad/u.m**2) * trapz(integrand, depth_grid.to_value(u.pc),
-                                          axis=2)
-    if beam_kernel_sd is not None:
-        RM = gaussian_filter(RM.value, sigma=beam_kernel_sd)*RM.unit
 
-    return RM
+def _trapezoidal_weights(z):
+    """
+    Computes the weights of the trapezoidal rule along the last axis
+
+    Parameters
+    ----------
+    z : numpy.ndarray
+        Sample points (the integration is performed along the last axis)
 
+    Returns
+    -------
+    w : numpy.ndarray
+        Array with the same shape as `z`, such that ``np.sum(f*w, axis=-1)``
+        is equivalent to ``trapz(f, z, axis=-1)``
+    """
+    dz = np.diff(z, axis=-1)
+    w = np.empty_like(z)
+    w[...,1:-1] = 0.5*(dz[...,:-1] + dz[...,1:])
+    w[...,0] = 0.5*dz[...,0]
+    w[...,-1] = 0.5*dz[...,-1]
+    return w
 
 
 def compute_Psi(U, Q):
@@ -151,10 +378,10 @@ def compute_Psi(U, Q):
     Psi : astropy.units.Quantity
         Polarization angle
     """
-    psi = np.arctan2(U,Q) / 2.
+    psi = np.arctan2(U.to_value(Q.unit), Q.value) / 2.
 
     # Unwraps the angles
-    psi = adjust_angles(psi.to_value(u.rad))*u.rad
+    psi = adjust_angles(psi) << u.rad
 
     return psi
 
@@ -175,13 +402,15 @@ def compute_RM(Psi1, Psi2, lambda1, lambda2):
     RM : astropy.units.Quantity
         Faraday rotation measure
     """
-    diff = Psi2 - Psi1
+    diff = Psi2.to_value(u.rad) - Psi1.to_value(u.rad)
 
     # Takes the smallest possible angle difference accounting for the
     # n-pi ambiguity   (needs to be checked)
-    diff = _adjust_diff(diff.to_value(u.rad))*u.rad
+    diff = _adjust_diff(diff)
+
+    delta_lambda2 = lambda2.to_value(u.m)**2 - lambda1.to_value(u.m)**2
 
-    return  diff / (lambda2**2 - lambda1**2)
+    return (diff / delta_lambda2) << u.rad/u.m**2
 
 
 @vectorize(['float64(float64)'], target='parallel')
@@ -199,12 +428,8 @@ def adjust_angles(psi):
     psi
         Angle in the correct range
     """
-    pi = np.pi
-    while (psi > pi):
-        psi -= 2*pi
-    while (psi <= -pi):
-        psi += 2*pi
-    return psi
+    # Closed form (bounded work per element) instead of while-loops
+    return psi + 2*math.pi*math.floor((math.pi - psi)/(2*math.pi))
 
 @vectorize(['float64(float64)'], target='parallel')
 def _adjust_diff(diff):
@@ -222,11 +447,7 @@ def _adjust_diff(diff):
     diff
         Angle difference in radians
     """
-    pi = np.pi
-    while (abs(diff-pi) < abs(diff)):
-        diff -= pi
-    while (abs(diff+pi) < abs(diff)):
-        diff += pi
-    return diff
+    # Closed form: maps the difference into the (-pi/2, pi/2] interval
+    return diff - math.pi*math.ceil(diff/math.pi - 0.5)
 
 
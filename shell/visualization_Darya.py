@@ -1,3 +1,4 @@
+from functools import lru_cache
 import matplotlib.pyplot as plt
 import numpy as np
 import astropy.units as u
@@ -5,8 +6,12 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredDrawingArea
 from matplotlib.patches import Circle
 
+@lru_cache(maxsize=64)
+def _latex_unit_str(unit):
+    return unit._repr_latex_().replace('$','')
+
 def get_latex_units(q):
-    return q.unit._repr_latex_().replace('$','')
+    return _latex_unit_str(q.unit)
 
 def plot_scalar_xy(grid, scalar_field, name='n', colormesh=True,
                    pos=None, ax=None, fig=None, **kwargs):
@@ -74,10 +79,13 @@ def plot_vector_xy(grid, vector_field, skip=3, name=r'\mathbf{B}',
         B = np.sqrt(Bx**2+By**2+Bz**2)
         name = '|'+name+'|'
 
-    im = ax.contourf(grid.x[:,:,pos],grid.y[:,:,pos], B[:,:,pos],
+    # Evaluates the coordinates of the slice only once
+    x, y = grid.x[:,:,pos].value, grid.y[:,:,pos].value
+
+    im = ax.contourf(x, y, B[:,:,pos].value,
                      alpha=contour_alpha, **kwargs)
     # Quiver does not handle units well. Does, we select the values instead
-    ax.quiver(grid.x[::skip,::skip,pos].value, grid.y[::skip,::skip,pos].value,
+    ax.quiver(x[::skip,::skip], y[::skip,::skip],
            Bx[::skip,::skip,pos].value, By[::skip,::skip,pos].value, color=quiver_color)
 
     ax.set_aspect(1)
@@ -100,18 +108,17 @@ def plot_polarization_vector(grid, I, PI, PA, ax=None, fig=None,
     if 'cmap' not in kwargs:
         kwargs['cmap'] = 'Reds'
     pos = grid.resolution[2]//2
+    # Evaluates the coordinates of the slice only once
+    x, y = grid.x[:,:,pos].value, grid.y[:,:,pos].value
 
     if colormesh:
-        im = ax.pcolormesh(grid.x[:,:,pos].value, grid.y[:,:,pos].value,
-                           PI.value, **kwargs)
+        im = ax.pcolormesh(x, y, PI.value, **kwargs)
     else:
-        im = ax.contourf(grid.x[:,:,pos], grid.y[:,:,pos], PI.value, **kwargs)
+        im = ax.contourf(x, y, PI.value, **kwargs)
     #plt.colorbar(im, label=r'PI')
     cax = plt.colorbar(im, ax=ax)
     cax.set_label(r'${}\;\left[\,{}\,\right]$'.format(r'\rm PI', get_latex_units(PI)))
 
-    x, y = grid.x[:,:,pos].value, grid.y[:,:,pos].value
-
     polarization_vector_x = PI/I * np.cos(PA + np.pi/2.0*u.rad)
     polarization_vector_y = PI/I * np.sin(PA + np.pi/2.0*u.rad)
     polarization_vector_x = polarization_vector_x[::skip,::skip].value
@@ -139,11 +146,14 @@ def plot_quiver_xy_E(grid, V, U, PI, unit, s,  skip=3, name=r'\mathbf{B}',
         # If no position is supplied, take the middle!
         pos = grid.resolution[2]//2
     
-    im = ax.contourf(grid.x[:,:,75],grid.y[:,:,75], PI,
+    # Evaluates the coordinates of the slice only once
+    x, y = grid.x[:,:,pos].value, grid.y[:,:,pos].value
+
+    im = ax.contourf(x, y, PI,
                       **kwargs)
     #im = ax.contourf(grid.x[:,:,pos],grid.y[:,:,pos], B[:,:,pos], alpha=contour_alpha, **kwargs)
     # Quiver does not handle units well. Does, we select the values instead
-    ax.quiver(grid.x[::6,::6,75].value, grid.y[::6,::6,75].value,
+    ax.quiver(x[::6,::6], y[::6,::6],
               -V[::6, ::6] , U[::6, ::6] ,  color=quiver_color, headwidth= 0)  #width=0.004)
     
     ada = AnchoredDrawingArea(2, 2, 0, 0, loc='lower left', pad=0., frameon=False, )
@@ -173,7 +183,7 @@ def plot_scalar2_xy(grid, PI, unite, s, name='n', colormesh=True,
         # If no position is supplied, take the middle!
         pos = grid.resolution[2]//2
     
-    im = ax.contourf(grid.x[:,:,75],grid.y[:,:,75], PI,
+    im = ax.contourf(grid.x[:,:,pos].value, grid.y[:,:,pos].value, PI,
                       **kwargs)
     
 
@@ -262,11 +272,14 @@ def plot_quiver_xy_B(grid, V, U, PI, unit, s,  skip=3, name=r'\mathbf{B}',
         # If no position is supplied, take the middle!
         pos = grid.resolution[2]//2
     
-    im = ax.contourf(grid.x[:,:,75],grid.y[:,:,75], PI,
+    # Evaluates the coordinates of the slice only once
+    x, y = grid.x[:,:,pos].value, grid.y[:,:,pos].value
+
+    im = ax.contourf(x, y, PI,
                       **kwargs)
     #im = ax.contourf(grid.x[:,:,pos],grid.y[:,:,pos], B[:,:,pos], alpha=contour_alpha, **kwargs)
     # Quiver does not handle units well. Does, we select the values instead
-    ax.quiver(grid.x[::6,::6,75].value, grid.y[::6,::6,75].value,
+    ax.quiver(x[::6,::6], y[::6,::6],
               U[::6, ::6] , V[::6, ::6] ,  color=quiver_color, headwidth= 0)  #width=0.004)
     
     ada = AnchoredDrawingArea(2, 2, 0, 0, loc='lower left', pad=0., frameon=False, )